@@ -1,14 +1,17 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import JSONResponse, FileResponse, Response
+from fastapi.responses import ORJSONResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-from handler import EndpointHandler
+from handler import get_handler
+from settings import CONFIG_PATH, HEATMAP_OUTPUT_PATH
 from contextlib import asynccontextmanager
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import logging
 import uvicorn
-import json
+import aiofiles
+import orjson
 import os
-from heatmap_gen import generate_heatmap, HEATMAP_OUTPUT_PATH
-import requests
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -17,32 +20,153 @@ logger = logging.getLogger(__name__)
 # Initialize handler as None
 handler = None
 
+# Error from the background model load, if it failed
+init_error = None
+
+# Micro-batching settings for /predict/
+MAX_BATCH = 8
+MAX_WAIT_MS = 10
+batch_queue = None
+
+# Upload limits for /predict/
+MAX_UPLOAD_SIZE = 10 * 1024 * 1024  # 10 MB
+UPLOAD_CHUNK_SIZE = 64 * 1024
+MAX_REQUEST_SIZE = MAX_UPLOAD_SIZE + 64 * 1024  # Allow for multipart framing
+MAX_BATCH_REQUEST_SIZE = MAX_REQUEST_SIZE * MAX_BATCH
+
+# Dedicated pool for preprocessing and inference, kept apart from the
+# default executor so other blocking calls can't queue in front of the model.
+# Created per lifespan, since a shut-down executor can't be reused
+INFER_POOL = None
+
+async def batch_worker():
+    """Collect queued images into batches and run one forward pass per batch."""
+    loop = asyncio.get_running_loop()
+    while True:
+        # Wait for the first image, then gather more until the batch is full
+        # or the wait window closes
+        batch = [await batch_queue.get()]
+        deadline = loop.time() + MAX_WAIT_MS / 1000
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        images = [image for image, _ in batch]
+        futures = [future for _, future in batch]
+        try:
+            counts = await loop.run_in_executor(
+                INFER_POOL, handler.predict_batch, images
+            )
+            for future, count in zip(futures, counts):
+                if not future.done():
+                    future.set_result(count)
+        except Exception as e:
+            logger.error(f"Batch inference error: {str(e)}")
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+
+async def init_handler():
+    """Build and warm up the shared handler without blocking startup."""
+    global handler, init_error
+    try:
+        handler = await asyncio.get_running_loop().run_in_executor(
+            INFER_POOL, get_handler
+        )
+        logger.info("Handler initialized successfully")
+    except Exception as e:
+        # Keep serving so / and the predict routes can report the failure
+        init_error = str(e)
+        logger.error(f"Failed to initialize handler: {str(e)}")
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager for FastAPI app."""
-    global handler
+    global handler, batch_queue, init_error, INFER_POOL
+    worker = init = None
+    init_error = None
     try:
-        # Initialize on startup
-        handler = EndpointHandler()
-        logger.info("Handler initialized successfully")
+        INFER_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="yolo")
+        batch_queue = asyncio.Queue()
+        worker = asyncio.create_task(batch_worker())
+        # Load and warm up the model in the background so the server starts
+        # at once; until then / reports "initializing" and /predict/ a 503,
+        # and if loading fails both report the error
+        init = asyncio.create_task(init_handler())
         yield
-    except Exception as e:
-        logger.error(f"Failed to initialize handler: {str(e)}")
-        raise
     finally:
         # Cleanup on shutdown
-        if handler and hasattr(handler, 'model'):
-            del handler.model
-            handler = None
+        for task in (worker, init):
+            if task:
+                task.cancel()
+        INFER_POOL.shutdown(wait=False)
+        # The handler itself is process-wide (get_handler), so only drop our
+        # reference; a later lifespan picks the same one up again
+        handler = None
 
 # Create FastAPI app without docs
 app = FastAPI(
     docs_url=None,    # Disable swagger documentation
     redoc_url=None,   # Disable redoc documentation
     openapi_url=None, # Disable openapi schema
+    default_response_class=ORJSONResponse, # Serialize responses with orjson
     lifespan=lifespan # Add lifespan context manager
 )
 
+def request_limit(path):
+    """Return the maximum request body size for a route"""
+    return MAX_BATCH_REQUEST_SIZE if path == "/predict_batch" else MAX_REQUEST_SIZE
+
+def too_large_detail(limit):
+    """Error message for a request over `limit` bytes"""
+    return f"File too large. Maximum size is {limit // (1024 * 1024)}MB"
+
+class LimitRequestSize:
+    """Reject request bodies over the route's limit while they are received.
+
+    Oversized Content-Lengths are refused before reading anything, and the
+    body is counted as it streams in, so a chunked upload without a
+    Content-Length is cut off too instead of being spooled in full by the
+    multipart parser.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        limit = request_limit(scope["path"])
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > limit:
+            response = ORJSONResponse(status_code=413, content={"detail": too_large_detail(limit)})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    # Raised while FastAPI parses the body, which passes
+                    # HTTPExceptions through, so the client gets a 413
+                    raise HTTPException(status_code=413, detail=too_large_detail(limit))
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(LimitRequestSize)
+
 # Configure CORS
 app.add_middleware(
     CORSMiddleware,
@@ -55,14 +179,18 @@ app.add_middleware(
 @app.get("/")
 async def root():
     """Root endpoint to check API status"""
-    return {
-        "status": "online",
-        "model_status": "loaded" if handler and handler.initialized else "initializing"
-    }
+    if init_error:
+        return {"status": "online", "model_status": "failed", "error": init_error}
+    if handler and handler.initialized:
+        return {
+            "status": "online",
+            "model_status": "loaded",
+            "model_version": handler.model_version
+        }
+    return {"status": "online", "model_status": "initializing"}
 
-@app.post("/predict/")
-async def predict(file: UploadFile = File(...)):
-    """Endpoint to predict crowd count from an image"""
+def validate_image(file: UploadFile):
+    """Reject uploads that are missing or not images"""
     if file is None or file.content_type is None:
         raise HTTPException(status_code=400, detail="Invalid file")
     
@@ -71,24 +199,67 @@ async def predict(file: UploadFile = File(...)):
             status_code=400,
             detail="File must be an image"
         )
-    
+
+def require_handler():
+    """Reject requests while the model is still loading or failed to load"""
+    if init_error:
+        raise HTTPException(
+            status_code=503,
+            detail=f"Model failed to load: {init_error}"
+        )
     if not handler or not handler.initialized:
         raise HTTPException(
             status_code=503,
             detail="Model is initializing. Please try again in a few moments."
         )
+
+async def read_upload(file: UploadFile):
+    """Read an already received upload, rejecting any single file over the cap.
+
+    The request body as a whole is bounded while it arrives by LimitRequestSize.
+    """
+    contents = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        contents.extend(chunk)
+        if len(contents) > MAX_UPLOAD_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=too_large_detail(MAX_UPLOAD_SIZE)
+            )
+    return contents
+
+@app.post("/predict/")
+async def predict(file: UploadFile = File(...)):
+    """Endpoint to predict crowd count from an image"""
+    validate_image(file)
+    require_handler()
     
     try:
-        contents = await file.read()
-        # Preprocess image and get prediction
-        count = handler.preprocess_image(contents)
+        contents = await read_upload(file)
+            
+        # Hash the upload and, on a cache miss, preprocess it in the pool so
+        # neither blocks the event loop; repeated uploads skip inference
+        def prepare():
+            key = handler.cache_key(contents)
+            count = handler.get_cached_count(key)
+            image = handler.preprocess_image(contents) if count is None else None
+            return key, count, image
+        
+        loop = asyncio.get_running_loop()
+        key, count, image = await loop.run_in_executor(INFER_POOL, prepare)
+        if count is None:
+            # Queue the image for the next batch
+            future = loop.create_future()
+            await batch_queue.put((image, future))
+            count = await future
+            handler.cache_count(key, count)
         
         result = {
             "count": count,
             "status": "success"
         }
             
-        return JSONResponse(content=result)
+        return result
         
     except HTTPException:
         raise
@@ -99,12 +270,56 @@ async def predict(file: UploadFile = File(...)):
             detail=str(e)
         )
 
+@app.post("/predict_batch")
+async def predict_batch(files: List[UploadFile] = File(...)):
+    """Endpoint to predict crowd counts for several images in one forward pass"""
+    if len(files) > MAX_BATCH:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {MAX_BATCH} images per batch"
+        )
+    for file in files:
+        validate_image(file)
+    require_handler()
+    
+    try:
+        contents = [await read_upload(file) for file in files]
+        
+        # Hash, look up and infer in the pool, off the event loop; only
+        # images missing from the cache go through the model
+        def infer_misses():
+            keys = [handler.cache_key(image_bytes) for image_bytes in contents]
+            counts = [handler.get_cached_count(key) for key in keys]
+            misses = [i for i, count in enumerate(counts) if count is None]
+            if misses:
+                images = [handler.preprocess_image(contents[i]) for i in misses]
+                for i, count in zip(misses, handler.predict_batch(images)):
+                    counts[i] = count
+                    handler.cache_count(keys[i], count)
+            return counts
+        
+        counts = await asyncio.get_running_loop().run_in_executor(INFER_POOL, infer_misses)
+        
+        return {
+            "counts": counts,
+            "status": "success"
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Batch prediction error: {str(e)}")
+        raise HTTPException(
+            status_code=500,
+            detail=str(e)
+        )
+
 @app.get("/heatmap")
 async def get_heatmap():
     """Serve the latest heatmap.svg file"""
     if not os.path.exists(HEATMAP_OUTPUT_PATH):
         raise HTTPException(status_code=404, detail="Heatmap SVG file not found")
-    return Response(content=open(HEATMAP_OUTPUT_PATH, 'rb').read(), media_type="image/svg+xml")
+    return FileResponse(HEATMAP_OUTPUT_PATH, media_type="image/svg+xml")
 
 @app.post("/update-data")
 async def update_data(data: dict):
@@ -116,18 +331,25 @@ async def update_data(data: dict):
             raise HTTPException(status_code=400, detail="No region data provided")
 
         # Save the updated region data to the config file
-        with open("config/regions.json", "w") as f:
-            json.dump({"regions": regions}, f)
+        async with aiofiles.open(CONFIG_PATH, "wb") as f:
+            await f.write(orjson.dumps({"regions": regions}))
+
+        # Import heatmap_gen (Flask, numpy, config loading) and generate the
+        # heatmap off the event loop
+        def regenerate_heatmap():
+            from heatmap_gen import generate_heatmap
+            generate_heatmap()
 
-        # Call the heatmap generation function
-        generate_heatmap()
+        await asyncio.get_running_loop().run_in_executor(None, regenerate_heatmap)
 
-        return JSONResponse(content={"message": "Heatmap updated successfully"})
+        return {"message": "Heatmap updated successfully"}
     
     except Exception as e:
         logger.error(f"Error updating heatmap: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
+    # A single worker serving the model loaded above; uvicorn picks uvloop
+    # and httptools on its own where they are installed
     uvicorn.run(app, host="127.0.0.1", port=8000)
 
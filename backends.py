@@ -0,0 +1,212 @@
+import logging
+import os
+import platform
+import shutil
+import threading
+from pathlib import Path
+import torch
+
+try:
+    import onnxruntime as ort
+    HAVE_ONNXRUNTIME = True
+except ImportError:
+    HAVE_ONNXRUNTIME = False
+
+try:
+    from openvino import Core
+    HAVE_OPENVINO = True
+except ImportError:
+    HAVE_OPENVINO = False
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _omp_threads(default=4):
+    """Read OMP_NUM_THREADS, falling back to `default` on an empty or invalid value."""
+    try:
+        return max(int(os.environ.get("OMP_NUM_THREADS", default)), 1)
+    except ValueError:
+        return default
+
+# Intra-op threads used by the CPU runtimes, same as torch's pool
+CPU_THREADS = _omp_threads()
+
+# YOLOv8 layers 0-9 form the backbone (Conv, C2f and SPPF blocks)
+BACKBONE_LAYERS = 10
+
+def _has_dynamic_batch(onnx_path):
+    """Return True if an ONNX file loads and its input batch dimension is symbolic."""
+    import onnx
+    try:
+        graph_input = onnx.load(str(onnx_path), load_external_data=False).graph.input[0]
+    except Exception:
+        return False
+    return bool(graph_input.type.tensor_type.shape.dim[0].dim_param)
+
+def export_onnx(weights_path, imgsz):
+    """Return a dynamic-batch ONNX export of the weights, saved next to them.
+
+    An existing export is only reused if its batch dimension is dynamic
+    (a plain `yolo export` is fixed at batch 1). New exports are written
+    under a per-process name and renamed into place, so workers exporting
+    at the same time never open a half-written file.
+    """
+    from ultralytics import YOLO
+
+    weights_path = Path(weights_path)
+    onnx_path = weights_path.with_suffix(".onnx")
+    if onnx_path.exists() and _has_dynamic_batch(onnx_path):
+        return onnx_path
+
+    logger.info("Exporting model to ONNX...")
+    # The exporter names its output after the weights, so export a private copy
+    tmp_weights = weights_path.with_name(f"{weights_path.stem}.{os.getpid()}{weights_path.suffix}")
+    shutil.copyfile(weights_path, tmp_weights)
+    try:
+        exported = YOLO(str(tmp_weights)).export(
+            format="onnx", imgsz=imgsz, opset=17, dynamic=True
+        )
+        os.replace(exported, onnx_path)
+    finally:
+        tmp_weights.unlink(missing_ok=True)
+        tmp_weights.with_suffix(".onnx").unlink(missing_ok=True)
+    return onnx_path
+
+class OnnxBackend:
+    """Run the exported YOLO graph with ONNX Runtime on the CPU.
+
+    Takes a normalised BCHW float tensor and returns the raw prediction
+    tensor, the same contract as the Ultralytics AutoBackend, so NMS and
+    counting stay shared.
+    """
+
+    def __init__(self, weights_path, imgsz):
+        # Export once and reuse the .onnx file saved next to the weights
+        onnx_path = export_onnx(weights_path, imgsz)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = CPU_THREADS
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            str(onnx_path), sess_options=options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        outputs = self.session.run(None, {self.input_name: batch.numpy()})
+        return torch.from_numpy(outputs[0])
+
+class TorchScriptBackend:
+    """Run a traced, frozen copy of the YOLO network with TorchScript on the CPU.
+
+    Fallback when neither OpenVINO nor ONNX Runtime is installed.
+    """
+
+    def __init__(self, module, imgsz):
+        dummy = torch.zeros(1, 3, imgsz, imgsz)
+        with torch.no_grad():
+            traced = torch.jit.trace(module.eval(), dummy, strict=False)
+            # Freezing inlines the weights so conv+bn+act can be fused
+            self.module = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+            # The first calls run the JIT's profiling passes, pay them now
+            for _ in range(2):
+                self.module(dummy)
+
+    def __call__(self, batch):
+        return self.module(batch)
+
+class Int8Backend:
+    """Run the YOLO network with its backbone convolutions quantized to INT8.
+
+    Uses PyTorch FX static quantization (FBGEMM on x86, QNNPACK on ARM).
+    The neck and Detect head stay in FP32.
+    """
+
+    def __init__(self, weights_path, calibration_batches):
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        from ultralytics import YOLO
+        from ultralytics.nn.modules import Conv
+
+        engine = "qnnpack" if platform.machine().lower() in ("arm64", "aarch64") else "fbgemm"
+        torch.backends.quantized.engine = engine
+        qconfig_mapping = get_default_qconfig_mapping(engine)
+
+        # Start from unfused weights, FX traces Conv.forward which still
+        # expects its BatchNorm
+        model = YOLO(str(weights_path)).model.float().eval()
+
+        # C2f and Detect iterate over / branch on tensors, which FX can't
+        # trace, so quantize each backbone Conv block on its own
+        names = [
+            name for name, module in model.model.named_modules()
+            if isinstance(module, Conv) and int(name.split(".")[0]) < BACKBONE_LAYERS
+        ]
+        for name in names:
+            conv = model.model.get_submodule(name)
+            example = torch.zeros(1, conv.conv.in_channels, 32, 32)
+            _replace_module(model.model, name, prepare_fx(conv, qconfig_mapping, (example,)))
+
+        # Collect activation ranges over the calibration images
+        with torch.no_grad():
+            for batch in calibration_batches:
+                model(batch)
+
+        for name in names:
+            _replace_module(model.model, name, convert_fx(model.model.get_submodule(name)))
+        self.model = model
+
+    def __call__(self, batch):
+        return self.model(batch)
+
+def _replace_module(root, name, module):
+    """Swap the submodule at a dotted path, keeping YOLO's layer routing attributes."""
+    parent_name, _, child = name.rpartition(".")
+    parent = root.get_submodule(parent_name) if parent_name else root
+    old = getattr(parent, child)
+    for attr in ("f", "i", "type", "np"):
+        if hasattr(old, attr):
+            setattr(module, attr, getattr(old, attr))
+    setattr(parent, child, module)
+
+def is_intel_cpu():
+    """Return True when running on an Intel CPU."""
+    if "intel" in platform.processor().lower():
+        return True
+    # platform.processor() is often empty on Linux, check cpuinfo instead
+    try:
+        with open("/proc/cpuinfo") as f:
+            return "GenuineIntel" in f.read()
+    except OSError:
+        return False
+
+class OpenVinoBackend:
+    """Run the YOLO graph with OpenVINO on Intel CPUs.
+
+    Same contract as OnnxBackend: BCHW float batch in, raw predictions out.
+    """
+
+    def __init__(self, weights_path, imgsz):
+        # OpenVINO reads the ONNX export directly, which avoids Ultralytics'
+        # OpenVINO exporter and the openvino-dev install it triggers
+        onnx_path = export_onnx(weights_path, imgsz)
+        core = Core()
+        self.compiled = core.compile_model(
+            core.read_model(str(onnx_path)),
+            "CPU",
+            config={
+                "PERFORMANCE_HINT": "LATENCY",
+                "INFERENCE_NUM_THREADS": str(CPU_THREADS),
+            }
+        )
+        self.output = self.compiled.output(0)
+        # Infer requests are not thread-safe, keep one per inference thread
+        self._tls = threading.local()
+
+    def __call__(self, batch):
+        request = getattr(self._tls, "request", None)
+        if request is None:
+            request = self._tls.request = self.compiled.create_infer_request()
+        outputs = request.infer({0: batch.numpy()})
+        return torch.from_numpy(outputs[self.output].copy())
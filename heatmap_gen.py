@@ -1,15 +1,33 @@
 import os
+import atexit
 import json
 import requests # type: ignore
+from requests.adapters import HTTPAdapter # type: ignore
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from contextlib import ExitStack
+import hashlib
+import shelve
+import numpy as np
 from flask import Flask, send_from_directory, abort, send_file, jsonify
 from flask_cors import CORS
+from settings import CONFIG_PATH, HEATMAP_OUTPUT_PATH
+
+try:
+    import ahocorasick # type: ignore
+except ImportError:
+    ahocorasick = None
 
 # Configuration
-CONFIG_PATH = "config/regions.json"
 IMAGE_DIR = "tests/images"
 MAP_SVG_PATH = "map.svg"  # Update path to where map.svg is stored
-HEATMAP_OUTPUT_PATH = "assets/heatmap.svg" # Update to a valid path
-API_ENDPOINT = "http://127.0.0.1:8000/predict/"
+BATCH_ENDPOINT = "http://127.0.0.1:8000/predict_batch"
+BATCH_SIZE = 8  # Images per /predict_batch request, at most the server's MAX_BATCH
+MAX_WORKERS = 8  # Concurrent /predict_batch requests
+AHOCORASICK_MIN_REGIONS = 20  # Use an Aho-Corasick automaton above this many regions
+COUNT_CACHE_PATH = "assets/count_cache"  # Persistent {image hash: count} cache
+COUNT_CACHE_VERSION_KEY = "model_version"  # Server model the cached counts came from
+REQUEST_TIMEOUT = 30  # Seconds to wait for the FastAPI server per request
 
 # Create assets directory if it doesn't exist
 os.makedirs("assets", exist_ok=True)
@@ -29,6 +47,28 @@ except json.JSONDecodeError:
 # Initialize crowd counts
 crowd_counts = {region["name"]: 0 for region in regions}
 
+# Region names in config order, used to gather counts for the heatmap
+region_names = [region["name"] for region in regions]
+
+# Normalise region names once for filename matching
+normalized_regions = [
+    (region["name"], region["name"].replace(" ", "").lower()) for region in regions
+]
+
+def build_region_automaton(normalized_regions):
+    """Build an Aho-Corasick automaton mapping each normalised name to (config index, name)."""
+    automaton = ahocorasick.Automaton()
+    for index, (name, normalized) in enumerate(normalized_regions):
+        if normalized not in automaton:
+            automaton.add_word(normalized, (index, name))
+    automaton.make_automaton()
+    return automaton
+
+# With many regions, find every candidate in one pass over the filename
+region_automaton = None
+if ahocorasick is not None and len(normalized_regions) > AHOCORASICK_MIN_REGIONS:
+    region_automaton = build_region_automaton(normalized_regions)
+
 def assign_image_to_region(image_path):
     """
     Assigns an image to a region based on its filename.
@@ -36,72 +76,118 @@ def assign_image_to_region(image_path):
     Example: restroom1_image1.png
     """
     filename = os.path.basename(image_path).lower()
-    for region in regions:
-        if region["name"].replace(" ", "").lower() in filename:
-            return region["name"]
-    return None
+    if region_automaton is not None:
+        # Keep the first region in config order, like the linear scan
+        matches = [match for _, match in region_automaton.iter(filename)]
+        return min(matches)[1] if matches else None
+    return next(
+        (name for name, normalized in normalized_regions if normalized in filename),
+        None
+    )
 
-def get_crowd_count(image_path):
+def create_session():
     """
-    Sends the image to the FastAPI /predict/ endpoint and retrieves the crowd count.
+    Creates a requests session with a keep-alive connection pool large enough
+    for MAX_WORKERS concurrent uploads.
     """
-    with open(image_path, "rb") as image_file:
-        files = {"file": ("image.jpg", image_file, "image/jpeg")}
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS * 2)
+    session.mount("http://", adapter)
+    return session
+
+# Shared by every call, so each upload reuses an open connection
+_SESSION = create_session()
+atexit.register(_SESSION.close)
+
+def get_crowd_counts(image_paths):
+    """
+    Sends a batch of images to the FastAPI /predict_batch endpoint, which runs
+    them through the model in one forward pass, and retrieves their crowd counts.
+    Returns None if the request fails.
+    """
+    with ExitStack() as stack:
+        files = [
+            ("files", ("image.jpg", stack.enter_context(open(image_path, "rb")), "image/jpeg"))
+            for image_path in image_paths
+        ]
         try:
-            response = requests.post(API_ENDPOINT, files=files)
+            response = _SESSION.post(BATCH_ENDPOINT, files=files, timeout=REQUEST_TIMEOUT)
             response.raise_for_status()
-            data = response.json()
-            count = data.get("count", 0)
-            print(f"Received count {count} for {image_path}")
-            return count
+            counts = response.json().get("counts", [])
+            for image_path, count in zip(image_paths, counts):
+                print(f"Received count {count} for {image_path}")
+            return counts
         except requests.exceptions.RequestException as e:
-            print(f"Error processing {image_path}: {e}")
-            return 0
+            print(f"Error processing batch {image_paths}: {e}")
+            return None
         except json.JSONDecodeError:
-            print(f"Error: Invalid JSON response for {image_path}")
-            return 0
+            print(f"Error: Invalid JSON response for batch {image_paths}")
+            return None
+
+def hash_image(image_path):
+    """
+    Hashes an image file's contents (SHA-256, hardware accelerated through
+    OpenSSL where the CPU supports it) to key the count cache.
+    """
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as image_file:
+        for chunk in iter(lambda: image_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Heatmap rectangle markup, filled in per region
+HEATMAP_OPACITY = 0.6
+RECT_TEMPLATE = (
+    '<rect x="{x}" y="{y}" width="{width}" height="{height}" '
+    'fill="{color}" fill-opacity="{opacity}" />\n'
+)
+
+@lru_cache(maxsize=1)
+def load_svg_map():
+    """
+    Reads the SVG map once and splits it at the closing </svg> tag, so the
+    heatmap rectangles can be joined in between on every call.
+    """
+    with open(MAP_SVG_PATH, "r") as svg_file:
+        svg_content = svg_file.read()
+    print(f"Loaded SVG map from {MAP_SVG_PATH}")
+    if "</svg>" not in svg_content:
+        raise ValueError("</svg> tag not found in the SVG file.")
+    svg_head, svg_tail = svg_content.rsplit("</svg>", 1)
+    return svg_head, "</svg>" + svg_tail
 
 def generate_heatmap():
     """
     Generates a heatmap based on the crowd counts and overlays it on the SVG map.
     """
     try:
-        with open(MAP_SVG_PATH, "r") as svg_file:
-            svg_content = svg_file.read()
-        print(f"Loaded SVG map from {MAP_SVG_PATH}")
+        svg_head, svg_tail = load_svg_map()
     except FileNotFoundError:
         print(f"Error: {MAP_SVG_PATH} not found.")
         return
+    except ValueError as e:
+        print(f"Error: {e}")
+        return
+
+    # Determine colors for all regions at once: green up to 7 people,
+    # orange up to 10, red above
+    counts = np.array([crowd_counts.get(name, 0) for name in region_names])
+    colors = np.select(
+        [counts <= 7, counts <= 10], ["#00FF00", "#FFA500"], default="#FF0000"
+    )
 
-    heatmap_rects = ""
-    for region in regions:
-        count = crowd_counts.get(region["name"], 0)
-        if count > 0:
-            # Determine color based on count
-            if count <= 7:
-                color = "#00FF00"  # Green
-                opacity = 0.6
-            elif count <= 10:
-                color = "#FFA500"  # Orange
-                opacity = 0.6
-            else:
-                color = "#FF0000"  # Red
-                opacity = 0.6
-
-            # Create a new rectangle element for the heatmap
-            heatmap_rect = (
-                f'<rect x="{region["x"]}" y="{region["y"]}" width="{region["width"]}" '
-                f'height="{region["height"]}" fill="{color}" fill-opacity="{opacity}" />'
-            )
-            heatmap_rects += heatmap_rect + "\n"
-            print(f"Added heatmap rectangle for {region['name']}: Color={color}, Opacity={opacity}")
+    heatmap_rects = []
+    for i in np.flatnonzero(counts > 0):
+        region, color = regions[i], colors[i]
+        # Create a new rectangle element for the heatmap
+        heatmap_rects.append(RECT_TEMPLATE.format(
+            x=region["x"], y=region["y"], width=region["width"], height=region["height"],
+            color=color, opacity=HEATMAP_OPACITY
+        ))
+        print(f"Added heatmap rectangle for {region['name']}: Color={color}, Opacity={HEATMAP_OPACITY}")
 
     # Insert the heatmap rectangles before the closing </svg> tag
-    if "</svg>" in svg_content:
-        heatmap_svg = svg_content.replace("</svg>", heatmap_rects + "</svg>")
-    else:
-        print("Error: </svg> tag not found in the SVG file.")
-        return
+    heatmap_svg = "".join([svg_head, *heatmap_rects, svg_tail])
 
     try:
         with open(HEATMAP_OUTPUT_PATH, "w") as heatmap_file:
@@ -113,28 +199,61 @@ def generate_heatmap():
 def main():
     # Ensure the FastAPI server is running
     try:
-        response = requests.get("http://127.0.0.1:8000/")
+        response = _SESSION.get("http://127.0.0.1:8000/", timeout=REQUEST_TIMEOUT)
         if response.status_code != 200:
             print("FastAPI server is not running properly. Please check the server.")
             return
+        model_version = response.json().get("model_version")
+        if model_version is None:
+            print("FastAPI server has not loaded the model. Please wait for it or check the server logs.")
+            return
         print("Connected to FastAPI server successfully.")
-    except requests.exceptions.ConnectionError:
+    except requests.exceptions.RequestException:
         print("Failed to connect to FastAPI server. Please ensure it's running on http://127.0.0.1:8000/")
         return
 
-    # Process each image
+    # Assign each image to a region
+    jobs = []
+    with os.scandir(IMAGE_DIR) as entries:
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False) and entry.name.lower().endswith(('.png', '.jpg', '.jpeg')):
+                region_name = assign_image_to_region(entry.path)
+                if region_name:
+                    jobs.append((entry.name, entry.path, region_name))
+                else:
+                    print(f"Could not assign {entry.name} to any region.")
+
     processed_images = 0
-    for image_file in os.listdir(IMAGE_DIR):
-        if image_file.lower().endswith(('.png', '.jpg', '.jpeg')):
-            image_path = os.path.join(IMAGE_DIR, image_file)
-            region_name = assign_image_to_region(image_path)
-            if region_name:
-                count = get_crowd_count(image_path)
-                crowd_counts[region_name] += count
-                print(f"Processed {image_file}: Region={region_name}, Count={count}")
-                processed_images += 1
-            else:
-                print(f"Could not assign {image_file} to any region.")
+    with shelve.open(COUNT_CACHE_PATH) as count_cache:
+        # Counts from a different model, backend or thresholds are stale
+        if count_cache.get(COUNT_CACHE_VERSION_KEY) != model_version:
+            count_cache.clear()
+            count_cache[COUNT_CACHE_VERSION_KEY] = model_version
+
+        # Images already counted in an earlier run skip the server entirely
+        digests = {image_path: hash_image(image_path) for _, image_path, _ in jobs}
+        pending = [
+            image_path for _, image_path, _ in jobs
+            if digests[image_path] not in count_cache
+        ]
+
+        # Send the rest in batches, concurrently over a shared keep-alive session
+        batches = [
+            pending[i:i + BATCH_SIZE] for i in range(0, len(pending), BATCH_SIZE)
+        ]
+        with ThreadPoolExecutor(MAX_WORKERS) as executor:
+            batch_counts = executor.map(get_crowd_counts, batches)
+            for batch, counts in zip(batches, batch_counts):
+                # Failed batches count as zero and are retried next run
+                if counts is not None:
+                    for image_path, count in zip(batch, counts):
+                        count_cache[digests[image_path]] = count
+
+        for image_file, image_path, region_name in jobs:
+            count = count_cache.get(digests[image_path], 0)
+            crowd_counts[region_name] += count
+            print(f"Processed {image_file}: Region={region_name}, Count={count}")
+            processed_images += 1
 
     if processed_images == 0:
         print("No images were processed. Please check the IMAGE_DIR and filenames.")
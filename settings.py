@@ -0,0 +1,4 @@
+# File paths shared by the FastAPI server and heatmap_gen. Kept free of
+# heavy imports so app.py can read them without loading heatmap_gen.
+CONFIG_PATH = "config/regions.json"
+HEATMAP_OUTPUT_PATH = "assets/heatmap.svg" # Update to a valid path
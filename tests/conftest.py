@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules under test are top-level scripts that use paths relative to
+# the repository root (models/, config/, assets/)
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("fastapi")
+from fastapi.testclient import TestClient
+
+import app as app_module
+
+# Used without `with`, so the lifespan never builds the handler: the size
+# limit has to reject these requests before any route needs the model
+client = TestClient(app_module.app)
+
+OVERSIZED = b"x" * (app_module.MAX_REQUEST_SIZE + 1)
+
+def test_predict_rejects_oversized_content_length():
+    response = client.post(
+        "/predict/", files={"file": ("image.jpg", OVERSIZED, "image/jpeg")}
+    )
+    assert response.status_code == 413
+    assert response.json()["detail"] == "File too large. Maximum size is 10MB"
+
+def test_predict_rejects_oversized_chunked_body():
+    def body():
+        for start in range(0, len(OVERSIZED), 1024 * 1024):
+            yield OVERSIZED[start:start + 1024 * 1024]
+
+    response = client.post(
+        "/predict/",
+        content=body(),
+        headers={"content-type": "multipart/form-data; boundary=boundary"}
+    )
+    assert "content-length" not in response.request.headers
+    assert response.status_code == 413
+
+def test_predict_batch_allows_more_than_the_single_upload_limit():
+    # Two 6MB images pass /predict_batch's larger limit and reach the route,
+    # which then reports the model as not loaded
+    image = b"x" * (6 * 1024 * 1024)
+    response = client.post(
+        "/predict_batch",
+        files=[("files", ("image.jpg", image, "image/jpeg"))] * 2
+    )
+    assert response.status_code == 503
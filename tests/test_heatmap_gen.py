@@ -0,0 +1,21 @@
+import itertools
+import os
+
+import pytest
+
+pytest.importorskip("ahocorasick")
+heatmap_gen = pytest.importorskip("heatmap_gen")
+
+def test_region_automaton_matches_linear_scan(monkeypatch):
+    names = [normalized for _, normalized in heatmap_gen.normalized_regions]
+    filenames = os.listdir(heatmap_gen.IMAGE_DIR) + ["unknown.png"] + [
+        # Filenames naming several regions must resolve to the first in config order
+        f"{first}_{second}.png" for first, second in itertools.permutations(names, 2)
+    ]
+
+    monkeypatch.setattr(heatmap_gen, "region_automaton", None)
+    linear = [heatmap_gen.assign_image_to_region(name) for name in filenames]
+
+    automaton = heatmap_gen.build_region_automaton(heatmap_gen.normalized_regions)
+    monkeypatch.setattr(heatmap_gen, "region_automaton", automaton)
+    assert [heatmap_gen.assign_image_to_region(name) for name in filenames] == linear